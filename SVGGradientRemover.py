@@ -1,36 +1,297 @@
-import xml.etree.ElementTree as ET
+import argparse
+import io
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+from lxml import etree as ET
 from svglib.svglib import svg2rlg
 from reportlab.graphics import renderPDF
 
-# Remove gradients from svg file and replace them by solid color
-# First open the svg file to be modified
-tree = ET.parse("Graphs-Screenshot.svg")
-root = tree.getroot()
-
-# Search for the linearGradient tag within the svg file
-for descendant in root.findall("{*}defs/{*}linearGradient"):
-    print(descendant)
-    id = descendant.get("id")
-    print("id: " + id)
-
-    # Extract the (first) color of the gradient as template
-    # for solid color fill.
-    # Might be extended to extract average of multiple colors
-    color = descendant[0].get("stop-color")
-    print("color: " + color)
-    print("{*}g/{*}"+id)
-
-    # Replace all gradients with previously extracted solid color
-    for gradient in root.iterfind("{*}g/"):
-        if gradient.get("fill") == ("url(#"+id+")"):
-            print("old gradient:", gradient.get("fill"))
-            gradient.set("fill", color)
-            print("new solid color:", gradient.get("fill"))
-            
-# Save the edited svg file
-tree.write("newSVG.svg", encoding="UTF-8")
-
-# Convert svg to reportlab own rlg format
-rlg = svg2rlg("newSVG.svg")
-# Save a PDF out of rlg file
-renderPDF.drawToFile(rlg, "Graphs-Screenshot.pdf")
+_LOG = logging.getLogger(__name__)
+LOG_FORMAT = "%(levelname)s: %(message)s"
+
+SVG_NS = "http://www.w3.org/2000/svg"
+STOP_TAG = f"{{{SVG_NS}}}stop"
+LINEAR_GRADIENT_TAG = f"{{{SVG_NS}}}linearGradient"
+# Qualified tags plus the bare names used by files without an xmlns
+STOP_TAGS = (STOP_TAG, "stop")
+LINEAR_GRADIENT_TAGS = (LINEAR_GRADIENT_TAG, "linearGradient")
+DEFS_TAGS = (f"{{{SVG_NS}}}defs", "defs")
+STYLE_TAGS = (f"{{{SVG_NS}}}style", "style")
+
+
+class Paths(NamedTuple):
+    """The svg file to clean up and the files written from it."""
+    input_svg: Path
+    output_svg: Path
+    output_pdf: Path
+
+
+# Only elements carrying a fill or style attribute can reference a gradient,
+# so let the parser's own query engine skip everything else
+find_fill_candidates = ET.XPath(".//*[@fill or @style]")
+
+# Matches a fill value of the form url(#id), quotes and whitespace allowed.
+# url() references are plain ASCII, which keeps \s a simple table lookup
+URL_REF_RE = re.compile(r"""url\(\s*['"]?#(?P<id>[^'")\s]+)['"]?\s*\)""", re.ASCII)
+
+
+def extract_url_ref_id(value):
+    """Return the id referenced by a stripped url(#id) value, or None."""
+    match = URL_REF_RE.match(value)
+    return match.group("id") if match else None
+
+
+# Matches a fill:url(#id) declaration inside a style attribute
+STYLE_FILL_RE = re.compile(r"""(?<![\w-])(fill\s*:\s*)url\(\s*['"]?#([^'")\s]+)['"]?\s*\)""",
+                           re.ASCII)
+
+
+@lru_cache(maxsize=4096)
+def parse_style(style):
+    """Split a style attribute into a tuple of (property, value) pairs.
+
+    Exported documents repeat the same style strings a lot, so results are
+    cached; the tuple keeps the shared result immutable.
+    """
+    return tuple((name.strip(), value.strip())
+                 for name, sep, value in (decl.partition(":")
+                                          for decl in style.split(";"))
+                 if sep)
+
+
+def stop_color(stop):
+    """Return the stop-color of a <stop>, set as attribute or in its style."""
+    color = stop.get("stop-color")
+    style = stop.get("style")
+    if color is None and style is not None and "stop-color" in style:
+        color = dict(parse_style(style)).get("stop-color")
+    return color
+
+
+def first_stop_color(gradient):
+    """Return the color of the first <stop> of a gradient that has one."""
+    # Iterate the children lazily and stop at the first hit; comments or
+    # other non-stop children are skipped
+    for child in gradient:
+        if child.tag in STOP_TAGS:
+            color = stop_color(child)
+            if color is not None:
+                return color
+    return None
+
+
+def gradient_href(gradient):
+    """Return the id a gradient takes its stops from via (xlink:)href."""
+    # One pass over the attributes covers href in any namespace or casing
+    for key, value in gradient.attrib.items():
+        if key.rpartition("}")[2].lower() == "href":
+            return value[1:] if value.startswith("#") else None
+    return None
+
+
+def referenced_ids(element):
+    """Yield the ids an element refers to via url(#id) or (xlink:)href.
+
+    The text of a <style> sheet counts as well, e.g. .st0{fill:url(#id)}.
+    """
+    for key, value in element.attrib.items():
+        if "url(" in value:
+            for match in URL_REF_RE.finditer(value):
+                yield match.group("id")
+        elif key.rpartition("}")[2].lower() == "href" and value.startswith("#"):
+            yield value[1:]
+    if element.tag in STYLE_TAGS and element.text and "url(" in element.text:
+        for match in URL_REF_RE.finditer(element.text):
+            yield match.group("id")
+
+
+def has_external_refs(root):
+    """Tell whether any (xlink:)href points to a file, e.g. an <image>."""
+    for element in root.iter(ET.Element):
+        for key, value in element.attrib.items():
+            if (key.rpartition("}")[2].lower() == "href"
+                    and not value.startswith(("#", "data:"))):
+                return True
+    return False
+
+
+def paths_for(input_svg):
+    """Derive the output file names from the svg file to clean up."""
+    return Paths(input_svg=input_svg,
+                 output_svg=input_svg.with_name(input_svg.stem + "_new.svg"),
+                 output_pdf=input_svg.with_suffix(".pdf"))
+
+
+def remove_gradients(paths):
+    """Replace the gradient fills of an svg file by solid colors.
+
+    Writes the edited svg and its pdf conversion and returns the number of
+    replaced fills.
+    """
+    # ReportLab (and older lxml versions) only take plain strings, convert once
+    input_svg = str(paths.input_svg)
+    output_pdf = str(paths.output_pdf)
+
+    # Open the svg file to be modified and pick up the linearGradient
+    # tags as the parser completes them, instead of searching the tree afterwards
+    colors = {}
+    links = {}
+    gradients = []
+    # lxml filters the events by tag in C, only gradients reach the loop
+    context = ET.iterparse(input_svg, events=("end",),
+                           tag=LINEAR_GRADIENT_TAGS)
+    for event, descendant in context:
+        id = descendant.get("id")
+        # Nothing can reference a gradient without an id
+        if id is None:
+            continue
+        gradients.append(descendant)
+
+        # Extract the (first) color of the gradient as template
+        # for solid color fill.
+        # Might be extended to extract average of multiple colors
+        color = first_stop_color(descendant)
+        _LOG.debug("Gradient #%s -> %s", id, color)
+        if color is not None:
+            colors[id] = color
+        else:
+            href = gradient_href(descendant)
+            if href is not None:
+                links[id] = href
+    root = context.root
+
+    # Gradients without stops of their own inherit them from the referenced one
+    for id, href in links.items():
+        seen = {id}
+        while href in links and href not in seen:
+            seen.add(href)
+            href = links[href]
+        if href in colors:
+            colors[id] = colors[href]
+    tree = ET.ElementTree(root)
+
+    # Replace all gradients with previously extracted solid color,
+    # looking up every fill once instead of rescanning per gradient
+    replaced = 0
+    for element in find_fill_candidates(root):
+        fill = element.get("fill")
+        # Cheap substring test before running the regex
+        if fill is not None and "url(" in fill:
+            gradient_id = extract_url_ref_id(fill.strip())
+            color = colors.get(gradient_id) if gradient_id is not None else None
+            if color is not None:
+                element.set("fill", color)
+                replaced += 1
+
+        # Rewrite fill:url(#id) inside style attributes in place, leaving the
+        # remaining declarations untouched
+        style = element.get("style")
+        if style is not None and "url(" in style:
+            new_style = STYLE_FILL_RE.sub(
+                lambda m: m.group(1) + colors[m.group(2)]
+                if m.group(2) in colors else m.group(0), style)
+            if new_style != style:
+                element.set("style", new_style)
+                replaced += 1
+    _LOG.debug("%s: replaced %d gradient fill(s) with solid colors.",
+               input_svg, replaced)
+
+    # Drop the replaced gradients, and any <defs> they leave empty, so
+    # svglib does not have to walk them. Gradients still referenced, e.g. by
+    # a stroke or by another gradient's href, have to stay
+    removable = {gradient.get("id"): gradient for gradient in gradients
+                 if gradient.get("id") in colors}
+    gradient_refs = {}
+    referenced = set()
+    for element in root.iter(ET.Element):
+        id = element.get("id")
+        if id in removable and removable[id] is element:
+            gradient_refs[id] = set(referenced_ids(element))
+        else:
+            referenced.update(referenced_ids(element))
+    # A gradient that stays also keeps the ones it refers to
+    keep = [id for id in referenced if id in removable]
+    while keep:
+        id = keep.pop()
+        if removable.pop(id, None) is not None:
+            keep.extend(gradient_refs.get(id, ()))
+
+    emptied = []
+    for gradient in removable.values():
+        parent = gradient.getparent()
+        parent.remove(gradient)
+        if len(parent) == 0 and parent.tag in DEFS_TAGS:
+            emptied.append(parent)
+    for defs in emptied:
+        defs.getparent().remove(defs)
+
+    # Serialize the edited svg file once, save it with a single write and
+    # reuse the same bytes for the conversion. No pretty printing: the added
+    # whitespace would end up in the rendered text
+    buf = io.BytesIO()
+    tree.write(buf, encoding="UTF-8", xml_declaration=True)
+    paths.output_svg.write_bytes(buf.getvalue())
+
+    # Convert the edited svg to reportlab own rlg format straight from
+    # memory instead of reading the saved file back from disk. svglib
+    # resolves relative files against the source path, which a buffer does
+    # not have, so fall back to the saved file next to the input for those
+    if has_external_refs(root):
+        rlg = svg2rlg(str(paths.output_svg))
+    else:
+        buf.seek(0)
+        rlg = svg2rlg(buf)
+    # Save a PDF out of rlg file
+    renderPDF.drawToFile(rlg, output_pdf)
+    return replaced
+
+
+def setup_logging(level):
+    """Log this script's messages at level, other libraries at WARNING.
+
+    Also used to set up worker processes, which may not inherit it.
+    """
+    logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+    _LOG.setLevel(level)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replace linear gradient fills in svg files by solid "
+                    "colors and convert the result to pdf.")
+    parser.add_argument(
+        "--input", nargs="+", type=Path,
+        default=[Path("Graphs-Screenshot.svg")],
+        help="svg file(s) to convert; writes <name>_new.svg and <name>.pdf "
+             "next to each (default: Graphs-Screenshot.svg)")
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0,
+        help="report progress; twice for per-file details")
+    args = parser.parse_args(argv)
+
+    # Quiet by default, only the aggregated result is logged at INFO
+    level = {0: logging.WARNING, 1: logging.INFO}.get(args.verbose,
+                                                      logging.DEBUG)
+    setup_logging(level)
+    jobs = [paths_for(input_svg) for input_svg in args.input]
+    if len(jobs) == 1:
+        total = remove_gradients(jobs[0])
+    else:
+        # Files are independent and the pdf rendering is CPU bound pure
+        # Python, so spread them over processes rather than threads
+        workers = min(len(jobs), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=setup_logging,
+                                 initargs=(level,)) as pool:
+            total = sum(pool.map(remove_gradients, jobs))
+    _LOG.info("Replaced %d gradient fill(s) in %d file(s).", total, len(jobs))
+
+
+if __name__ == "__main__":
+    main()